@@ -1,28 +1,63 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import Dict, Any, Optional, List
+from fastapi import FastAPI, HTTPException, Request, Depends
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+import msgspec
+from typing import Dict, Any, Optional, List, Callable, Awaitable
 import os
+import re
+import random
+import asyncio
+import hashlib
+import logging
+from collections import deque
 from datetime import datetime
-import json
+import orjson
+import httpx
+from contextlib import asynccontextmanager
 
 # LangGraph and LangChain imports
 from langgraph.graph import StateGraph, END
-from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.runnables import RunnableConfig
 from typing_extensions import TypedDict
 
 # Groq imports
-from groq import Groq
+from groq import AsyncGroq
+
+from cachetools import LFUCache, LRUCache, TTLCache
+
+import redis.asyncio as redis
 
 from dotenv import load_dotenv
 
 # Get environmental variabls
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Stop the intent batcher and close the shared network clients on shutdown"""
+    yield
+    await intent_batcher.close()
+    await groq_client.close()
+    if redis_client is not None:
+        await redis_client.aclose()
+
 # Initialize FastAPI app
-app = FastAPI(title="Multi-Tool Restaurant Chatbot", version="1.0.0")
+app = FastAPI(title="Multi-Tool Restaurant Chatbot", version="1.0.0", lifespan=lifespan, default_response_class=ORJSONResponse)
 
-# Initialize Groq client
-groq_client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+# Initialize Groq client on a pooled HTTP/2 connection, so concurrent calls share warm TLS connections
+groq_client = AsyncGroq(
+    api_key=os.getenv("GROQ_API_KEY"),
+    http_client=httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        timeout=httpx.Timeout(30.0, connect=5.0)
+    )
+)
+
+# Sessions are shared through Redis when REDIS_URL is set, so several workers can serve the same user
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = redis.from_url(REDIS_URL) if REDIS_URL else None
 
 # Mini Knowledge Base - General World Knowledge
 KNOWLEDGE_BASE = {
@@ -48,10 +83,302 @@ KNOWLEDGE_BASE = {
     "volcano_active": "Mount Etna in Italy is one of the most active volcanoes in the world and has frequent eruptions."
 }
 
+# Local lookup for knowledge questions: a KB entry matches when the question names all of its topic words
+# and asks about nothing the entry doesn't mention
+KNOWLEDGE_REDIRECT = "Now, shall we get back to your table reservation?"
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset({
+    "a", "an", "the", "is", "are", "was", "were", "be", "of", "in", "on", "at", "to", "for", "by", "with",
+    "and", "or", "it", "its", "this", "that", "what", "whats", "which", "who", "how", "many", "much",
+    "when", "where", "why", "do", "does", "did", "can", "could", "you", "me", "i", "tell", "about", "please"
+})
+
+def normalize_text(text: str) -> str:
+    """Lowercased words of the text, possessives stripped, in their original order"""
+    return " ".join(TOKEN_RE.findall(text.lower().replace("'s", "")))
+
+def content_tokens(text: str) -> frozenset:
+    """Words of the text that carry meaning, without stopwords"""
+    return frozenset(normalize_text(text).split()) - STOPWORDS
+
+# (topic words, every word of the topic and answer) per KB entry
+KNOWLEDGE_INDEX = {
+    key: (content_tokens(key.replace("_", " ")), content_tokens(f"{key.replace('_', ' ')} {value}"))
+    for key, value in KNOWLEDGE_BASE.items()
+}
+
+# Context-free LLM answers to knowledge questions the KB lookup missed, keyed by the normalized question.
+# Shared by all sessions, so it is only read once the intent is known and only holds answers written without session context.
+knowledge_cache: LRUCache = LRUCache(maxsize=1024)
+
+def lookup_knowledge(user_msg: str) -> Optional[str]:
+    """Answer a knowledge question without the LLM when it matches a KB entry"""
+    query = content_tokens(user_msg)
+    if not query:
+        return None
+    
+    for key, (topic, vocabulary) in KNOWLEDGE_INDEX.items():
+        if topic <= query <= vocabulary:
+            return f"{KNOWLEDGE_BASE[key].rstrip('.')}. {KNOWLEDGE_REDIRECT}"
+    return None
+
+def cached_knowledge_answer(user_msg: str) -> Optional[str]:
+    """A previous context-free LLM answer to the same question"""
+    return knowledge_cache.get(normalize_text(user_msg))
+
+def remember_knowledge_answer(user_msg: str, response: str) -> None:
+    """Cache an LLM answer so the same question is served locally next time"""
+    question = normalize_text(user_msg)
+    if question and not response.startswith("Error getting LLM response"):
+        knowledge_cache[question] = response
+
+# Canned replies for gibberish and profanity
+GIBBERISH_RESPONSE = "I’m sorry, I didn’t catch that—could you rephrase?"
+PROFANITY_RESPONSES = (
+    "Let's keep our conversation respectful, please. I'm here to help with your restaurant needs.",
+    "I'd appreciate if we could maintain a polite conversation. How can I assist you with our restaurant services?",
+    "Let's focus on how I can help you today. I can assist with reservations or answer questions about our restaurant.",
+    "I'm here to provide helpful service. Please let me know how I can assist you with restaurant-related questions."
+)
+
+# Local intent classification: cheap checks for intents with canned replies, so they never reach the LLM.
+# Only unambiguous profanity is caught here; words that can be names or mild ("Dick", "stupid") go to the LLM.
+PROFANITY_WORDS = frozenset({
+    "fuck", "fucking", "fucker", "fucked", "motherfucker", "shit", "shitty", "bullshit", "bitch",
+    "asshole", "cunt", "wtf", "stfu", "retard"
+})
+# Chat abbreviations and interjections that look like keyboard mashing but are real answers
+CHAT_WORDS = frozenset({
+    "tmrw", "tmr", "tmrow", "thx", "thnx", "thnks", "pls", "plz", "hmm", "hm", "mm", "mmm", "brb", "btw", "idk",
+    "np", "ppl", "wknd", "hrs", "hr", "mins", "pm", "am", "ok", "kk", "sry", "ty", "nvm", "lol", "omg", "asap", "tbh"
+})
+KEYBOARD_RUNS = tuple(row[i:i + 5] for row in ("qwertyuiop", "asdfghjkl", "zxcvbnm") for i in range(len(row) - 4))
+WORD_RE = re.compile(r"[a-z]+")
+LETTER_RUN_RE = re.compile(r"(.)\1+")
+CONSONANT_RUN_RE = re.compile(r"[bcdfghjklmnpqrstvwxz]{6,}")
+REPEATED_CHUNK_RE = re.compile(r"([a-z]{3,})\1\1")
+
+def is_keyboard_mash(word: str) -> bool:
+    """Strong sign of keyboard mashing: a keyboard run or a chunk typed three times over"""
+    if word in CHAT_WORDS:
+        return False
+    return any(run in word for run in KEYBOARD_RUNS) or REPEATED_CHUNK_RE.search(word) is not None
+
+def is_unpronounceable(word: str) -> bool:
+    """Weak sign of mashing: a long consonant run, which real words ("Knightsbridge", "Borschtsch") have too"""
+    collapsed = LETTER_RUN_RE.sub(r"\1", word)  # "hmmmm" -> "hm"
+    return word not in CHAT_WORDS and collapsed not in CHAT_WORDS and CONSONANT_RUN_RE.search(collapsed) is not None
+
+def classify_locally(user_msg: str) -> Optional[str]:
+    """Return the intent when it is certain without the LLM, otherwise None"""
+    words = WORD_RE.findall(user_msg.lower())
+    if not words:
+        return None
+    if PROFANITY_WORDS.intersection(words):
+        return "profanity"
+    # Every word must look mashed, and at least one must show a strong sign of it
+    if all(is_keyboard_mash(word) or is_unpronounceable(word) for word in words) and any(map(is_keyboard_mash, words)):
+        return "gibberish"
+    return None
+
+GREETING_RE = re.compile(r"\s*(hi|hello|hey|yo|hiya)( there)?[\s!.,]*", re.IGNORECASE)
+SLOT_QUESTIONS = {
+    "date": "What date would you like to book a table for?",
+    "time": "What time would you prefer?",
+    "persons": "How many people will be dining?"
+}
+
+
+# Static prompt prefixes, built once so they are byte-identical across calls (provider-side prompt caching).
+# Only the per-turn details are sent in the user message.
+KB_CONTENT = "\n".join([f"- {key.replace('_', ' ').title()}: {value}" for key, value in KNOWLEDGE_BASE.items()])
+
+INTENT_CATEGORIES = """
+Categories:
+1. "reservation" - Messages about booking/reserving tables, providing date/time/persons, availability questions, confirming reservations
+
+2. "knowledge" - General world knowledge questions about science, geography, history, facts, trivia, or educational topics (NOT related to restaurants)
+
+3. "gibberish" - Messages that are nonsensical, random characters, unclear mumbling, or completely incomprehensible text
+
+4. "contradiction" - Messages containing obviously false statements, contradictory claims, or statements that go against common knowledge/facts
+
+5. "profanity" - Messages containing rude language, insults, offensive content, or disrespectful behavior
+
+
+Any greeting message like Hello, Hey, Hi then consider "reservation".
+
+Examples:
+- "Book table for 4 tomorrow" → reservation
+- "What's the capital of France?" → knowledge  
+- "How fast is light?" → knowledge
+- "asdflkj qwerty zxcvbn" → gibberish
+- "Is ice hot?" → contradiction
+- "You're stupid" → profanity
+"""
+
+ANALYSIS_SYSTEM_PROMPT = f"""
+You are a helpful restaurant reservation assistant. For the user message you must, in one step,
+classify it, extract any reservation details and write your reply to the user.
+The user turn contains the recent conversation, the current reservation status and the user message.
+
+{INTENT_CATEGORIES}
+Reservation details (only for "reservation", otherwise set all of them to null):
+1. If the message contains more than one date or time, set both 'date' and 'time' to null.
+2. Extract 'date' and 'time' only if they are mentioned once and clearly in the user message.
+3. If any of the fields (date, time, persons) are not found, set them to null.
+
+Reply rules:
+- "reservation": Collect the date, time and number of persons. Use the conversation history to maintain context,
+  acknowledge any new information and ask for the next missing piece naturally. Don't ask for information you already have.
+  If multiple date candidates remain unresolved (e.g. "this weekend or maybe Monday morning"), ask one clarifying
+  question ("Do you prefer Saturday, Sunday, or Monday morning?") rather than assuming.
+  If the user has provided all three details and confirms all the details, then reply only YES.
+- "knowledge": Answer from the knowledge base below. If the question isn't covered, politely say I dont have information on that.
+  Then politely redirect the user back to table reservations without extra question added.
+- "contradiction": Politely correct the misinformation with the accurate facts in just one sentence,
+  then tell the customer to continue the reservation conversation with no extra question added.
+- "gibberish" or "profanity": reply with an empty string.
+
+KNOWLEDGE BASE:
+{KB_CONTENT}
+
+Respond with ONLY a JSON object in this format:
+{{
+"intent": "reservation, knowledge, gibberish, contradiction, or profanity",
+"date": "date or day of the week, or null",
+"time": "time in readable format or null",
+"persons": number of persons as integer or null,
+"response": "your reply to the user"
+}}
+"""
+
+BATCH_CLASSIFICATION_SYSTEM_PROMPT = f"""
+The user turn is a JSON array of user messages. Classify each message into ONE of these categories:
+
+{INTENT_CATEGORIES}
+
+Respond with ONLY a JSON object holding one category per array element, in the same order as the array:
+{{"intents": ["reservation, knowledge, gibberish, contradiction, or profanity", ...]}}
+"""
+
+RESERVATION_SYSTEM_PROMPT = """
+You are a helpful restaurant reservation assistant. Your job is to collect three required pieces of information:
+1. Date (when they want to dine)
+2. Time (what time they prefer)  
+3. Number of persons (how many people)
+
+The user turn contains the recent conversation, the current reservation status and the user message.
+
+-if user has provided all three information, then ask to confirm these details.
+-if user confirms all the details, then return only YES in response. otherwise continue the conversation.
+
+Instructions:
+
+Parse “fuzzy” time expressions (e.g., “book a table this weekend or maybe
+Monday morning”) into a structured “BookReservation” intent with candidate slots
+(date_candidates = [“this Saturday”, “this Sunday”, “Monday morning”]).
+
+-If multiple candidates remain unresolved, the chatbot must proactively ask one
+clarifying question (“Do you prefer Saturday, Sunday, or Monday morning?”)
+rather than assuming or failing silently
+
+- Use the conversation history to maintain context
+- If the user message contains any missing information, extract and acknowledge it
+- Ask for the next missing piece of information naturally
+- If you have all three pieces, confirm the reservation
+- Be conversational and remember what was discussed before
+- Don't ask for information you already have
+
+-if user has provided all three details and confirms all the details, then return only YES in response. otherwise continue the conversation.
+Respond naturally and ask for the next needed information if incomplete.
+"""
+
+EXTRACTION_SYSTEM_PROMPT = """
+You are an information extractor.
+
+Your task is to extract reservation details from the user message.
+
+Follow these rules strictly:
+1. If the message contains more than one date or time, set both 'date' and 'time' to null.
+2. Extract 'date' and 'time' only if they are mentioned once and clearly.
+3. If any of the fields (date, time, persons) are not found, set them to null.
+4. Return ONLY a raw JSON object, without any explanation, markdown, or labels.
+5. Do not include keys with invalid values like empty strings; use `null`.
+
+Expected JSON format:
+{
+"date": "date or day of the week, or null",
+"time": "time in readable format or null",
+"persons": number of persons as integer or null
+}
+
+Examples:
+Input: Book on this Monday or Tuesday  
+Output: {"date": null, "time": null, "persons": null}
+
+Input: Book on this Monday  
+Output: {"date": "Monday", "time": null, "persons": null}
+
+Input: Book for 12pm, 2 people  
+Output: {"date": null, "time": "12 pm", "persons": 2}
+"""
+
+KNOWLEDGE_SYSTEM_PROMPT = f"""
+You are a helpful AI assistant with access to general world knowledge. Use the following knowledge base to answer the user's question:
+
+KNOWLEDGE BASE:
+{KB_CONTENT}
+
+Instructions:
+- Use the information from the knowledge base above to answer questions
+- If the question isn't covered in the knowledge base, politely say I dont have information on that.
+- After answering the knowledge question, politely remind the user to redirect them back to table reservations without extra question added.
+
+Provide a helpful short response and then redirect to reservations.
+"""
+
+CONTRADICTION_SYSTEM_PROMPT = """
+The user made a statement that contains a contradiction or false information.
+
+Politely correct the misinformation with the accurate facts in just one sentence. 
+After the correction, Tell customer to continue reservation conversaton with no extra question added.
+
+Keep the response very precise and short; and redirect to restaurant services.
+"""
+
+# Per-turn prompt templates, formatted with the few values that change between calls
+TURN_PROMPT_TEMPLATE = """
+{conversation_context}
+{reservation_context}
+
+User message: "{user_msg}"
+"""
+
+RESERVATION_STATUS_TEMPLATE = """
+Current reservation status:
+- Date: {date}
+- Time: {time}
+- Number of persons: {persons}
+"""
+
+EXTRACTION_PROMPT_TEMPLATE = """
+Now extract from this:
+"{user_msg}"
+"""
+
+CONFIRMATION_TEMPLATE = """
+Reservation details:
+Date: {date},
+Time: {time},
+Persons: {persons}
+
+Please respond with "yes please confirm" or let me know for any change.
+"""
+
 
 # State definition for LangGraph
 class ChatbotState(TypedDict):
-    messages: list
     user_message: str
     intent: str  # 'reservation', 'knowledge', 'gibberish', 'contradiction', 'profanity'
     date: Optional[str]
@@ -59,292 +386,369 @@ class ChatbotState(TypedDict):
     persons: Optional[int]
     reservation_complete: bool
     conversation_history: list
+    slots: Dict[str, Any]  # Reservation details found this turn, applied by handle_reservation after the confirmation check
+    reply: Optional[str]  # Assistant reply for this turn, drafted by analyze_message or written by the handler
 
-# Pydantic models for API
-class ChatMessage(BaseModel):
+# msgspec models for API, decoded and encoded without the Pydantic validation pipeline
+class ChatMessage(msgspec.Struct):
     message: str
-    session_id: Optional[str] = "default"
+    session_id: str = "default"
 
-class ChatResponse(BaseModel):
+class ChatResponse(msgspec.Struct):
     response: str
     intent: str
     reservation_status: Dict[str, Any]
 
-# In-memory storage for sessions
-sessions: Dict[str, ChatbotState] = {}
+chat_message_decoder = msgspec.json.Decoder(ChatMessage)
+
+def json_schema(struct_type: type) -> Dict[str, Any]:
+    """Inline JSON schema of a msgspec struct, for the OpenAPI docs"""
+    _, components = msgspec.json.schema_components([struct_type])
+    return components[struct_type.__name__]
+
+# The body is decoded by msgspec rather than FastAPI, so the request and response schemas are declared explicitly
+CHAT_REQUEST_BODY = {"content": {"application/json": {"schema": json_schema(ChatMessage)}}, "required": True}
+CHAT_RESPONSE_SCHEMA = json_schema(ChatResponse)
 
-def get_llm_response(prompt: str, model: str = "llama3-70b-8192") -> str:
-    """Get response from Groq LLM"""
+async def decode_chat_message(request: Request) -> ChatMessage:
+    """Decode and validate a chat request body"""
     try:
-        chat_completion = groq_client.chat.completions.create(
-            messages=[{"role": "user", "content": prompt}],
+        return chat_message_decoder.decode(await request.body())
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+# In-memory storage for sessions (used without Redis), bounded in size and expired after an hour of inactivity
+MAX_SESSIONS = 10_000
+SESSION_TTL_SECONDS = 3600
+HISTORY_LENGTH = 12  # Messages kept per session
+CONTEXT_LENGTH = 6  # Messages sent to the LLM as conversation context
+sessions: TTLCache = TTLCache(maxsize=MAX_SESSIONS, ttl=SESSION_TTL_SECONDS)
+
+VALID_INTENTS = ["reservation", "knowledge", "gibberish", "contradiction", "profanity"]
+
+# Streamed replies are pushed to a token sink supplied through the workflow config
+TokenSink = Callable[[str], Awaitable[None]]
+
+def get_token_sink(config: Optional[RunnableConfig]) -> Optional[TokenSink]:
+    """Token sink of a streamed turn, or None for regular turns"""
+    return (config or {}).get("configurable", {}).get("on_token")
+
+# Smallest capable model per subtask: labels and slot extraction on 8B, user-facing replies on 70B
+CLASSIFIER_MODEL = "llama-3.1-8b-instant"
+EXTRACTOR_MODEL = "llama-3.1-8b-instant"
+REPLY_MODEL = "llama3-70b-8192"
+
+# Completions are deterministic (temperature=0), so identical prompts can reuse a previous response
+llm_cache: LFUCache = LFUCache(maxsize=4096)
+
+async def get_llm_response(
+    prompt: str,
+    model: str = REPLY_MODEL,
+    json_mode: bool = False,
+    system: Optional[str] = None,
+    on_token: Optional[TokenSink] = None
+) -> str:
+    """Get response from Groq LLM, optionally with a static system prompt and constrained to a JSON object.
+
+    When on_token is given the completion is streamed and each token is passed to it as it arrives.
+    """
+    cache_key = hashlib.blake2b(f"{model}|{json_mode}|{system}|{prompt}".encode(), digest_size=16).digest()
+    cached = llm_cache.get(cache_key)
+    if cached is not None:
+        if on_token:
+            await on_token(cached)
+        return cached
+    
+    try:
+        messages = [{"role": "system", "content": system}] if system else []
+        messages.append({"role": "user", "content": prompt})
+        options = {"response_format": {"type": "json_object"}} if json_mode else {}
+        chat_completion = await groq_client.chat.completions.create(
+            messages=messages,
             model=model,
             temperature=0,
-            max_tokens=500
+            max_tokens=500,
+            stream=on_token is not None,
+            **options
         )
-        return chat_completion.choices[0].message.content.strip()
+        if on_token:
+            tokens = []
+            async for chunk in chat_completion:
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    tokens.append(delta)
+                    await on_token(delta)
+            response = "".join(tokens).strip()
+        else:
+            response = chat_completion.choices[0].message.content.strip()
     except Exception as e:
         return f"Error getting LLM response: {str(e)}"
-
-def analyze_message(state: ChatbotState) -> ChatbotState:
-    """Analyze user message and route to appropriate tool"""
-    user_msg = state["user_message"]
     
-    # Get available knowledge base topics
-    kb_topics = ", ".join(KNOWLEDGE_BASE.keys())
-    
-    analysis_prompt = f"""
-    Analyze the following user message and classify it into ONE of these categories:
+    llm_cache[cache_key] = response
+    return response
 
-    User message: "{user_msg}"
+class IntentBatcher:
+    """Micro-batcher that classifies messages from concurrent turns in a single LLM call.
 
-    Categories:
-    1. "reservation" - Messages about booking/reserving tables, providing date/time/persons, availability questions, confirming reservations
-    
-    2. "knowledge" - General world knowledge questions about science, geography, history, facts, trivia, or educational topics (NOT related to restaurants)
-    
-    3. "gibberish" - Messages that are nonsensical, random characters, unclear mumbling, or completely incomprehensible text
-    
-    4. "contradiction" - Messages containing obviously false statements, contradictory claims, or statements that go against common knowledge/facts
+    An idle batcher dispatches a message right away. While classifications are in flight, messages are
+    collected for up to max_wait seconds, or until max_batch_size are pending.
+    """
     
-    5. "profanity" - Messages containing rude language, insults, offensive content, or disrespectful behavior
+    def __init__(self, max_batch_size: int = 8, max_wait: float = 0.05):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue: Optional[asyncio.Queue] = None
+        self.worker: Optional[asyncio.Task] = None
+        self.batches: set = set()
     
+    async def classify(self, user_msg: str) -> str:
+        """Intent of one message, resolved together with the rest of its batch"""
+        # Started lazily so the queue belongs to the running event loop
+        if self.worker is None or self.worker.done():
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.create_task(self.collect_batches())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((user_msg, future))
+        return await future
     
-    Any greeting message like Hello, Hey, Hi then consider "reservation".
-
-    Examples:
-    - "Book table for 4 tomorrow" → reservation
-    - "What's the capital of France?" → knowledge  
-    - "How fast is light?" → knowledge
-    - "asdflkj qwerty zxcvbn" → gibberish
-    - "Is ice hot?" → contradiction
-    - "You're stupid" → profanity
+    async def collect_batches(self) -> None:
+        """Drain the queue into batches and dispatch them"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            # Only wait for more messages when concurrent turns are already waiting on the LLM
+            deadline = loop.time() + (self.max_wait if self.batches else 0)
+            while len(batch) < self.max_batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            # Classify in the background so the next batch starts collecting right away
+            task = asyncio.create_task(self.classify_batch(batch))
+            self.batches.add(task)
+            task.add_done_callback(self.batches.discard)
     
+    async def request_intents(self, user_msgs: List[str]) -> Optional[List[str]]:
+        """One intent per message from a single LLM call.
 
-    Respond with ONLY one word: reservation, knowledge, gibberish, contradiction, or profanity
-    """
-    
-    intent = get_llm_response(analysis_prompt).lower().strip()
-    valid_intents = ["reservation", "knowledge", "gibberish", "contradiction", "profanity"]
+        Returns None only when the answer parsed but its count doesn't match the messages; a failed call or
+        unparseable answer gives every message the default intent.
+        """
+        # Messages are sent as a JSON array, so their text can't spill into another message's slot
+        prompt = orjson.dumps(user_msgs).decode()
+        result = await get_llm_response(prompt, model=CLASSIFIER_MODEL, json_mode=True, system=BATCH_CLASSIFICATION_SYSTEM_PROMPT)
+        try:
+            parsed = orjson.loads(result)
+        except orjson.JSONDecodeError:
+            parsed = None
+        intents = parsed.get("intents") if isinstance(parsed, dict) else None
+        if not isinstance(intents, list):
+            logger.warning("Could not classify %d messages: %r", len(user_msgs), result)
+            return ["reservation"] * len(user_msgs)  # Default fallback
+        if len(intents) != len(user_msgs):
+            logger.warning("Got %d intents for %d messages: %r", len(intents), len(user_msgs), result)
+            return None
+        
+        intents = [str(intent).lower().strip() for intent in intents]
+        return [intent if intent in VALID_INTENTS else "reservation" for intent in intents]  # Default fallback
     
-    if intent not in valid_intents:
-        intent = "reservation"  # Default fallback
+    async def classify_batch(self, batch: list) -> None:
+        """Classify a batch with one LLM call and resolve each waiting future"""
+        user_msgs = [user_msg for user_msg, _ in batch]
+        intents: Optional[List[str]] = None
+        try:
+            intents = await self.request_intents(user_msgs)
+            if intents is None and len(batch) > 1:
+                # A miscounted answer can't be assigned by position, so classify the messages one by one
+                singles = await asyncio.gather(*(self.request_intents([user_msg]) for user_msg in user_msgs))
+                intents = [single[0] if single else "reservation" for single in singles]
+        except Exception:
+            logger.exception("Batch classification of %d messages failed", len(batch))
+        finally:
+            for i, (_, future) in enumerate(batch):
+                if not future.done():
+                    future.set_result(intents[i] if intents else "reservation")  # Default fallback
     
-    state["intent"] = intent
-    return state
+    async def close(self) -> None:
+        """Stop collecting batches"""
+        if self.worker is not None:
+            self.worker.cancel()
 
-def handle_reservation(state: ChatbotState) -> ChatbotState:
-    """Handle reservation-related conversation with persistent context"""
-    user_msg = state["user_message"]
-    current_date = state.get("date")
-    current_time = state.get("time")
-    current_persons = state.get("persons")
-    
-    # Build conversation context from history
-    recent_messages = state.get("conversation_history", [])  # Last 6 messages for context
+intent_batcher = IntentBatcher()
+
+def build_conversation_context(state: ChatbotState) -> str:
+    """Format the conversation history for reservation prompts"""
+    recent_messages = list(state.get("conversation_history", []))[-CONTEXT_LENGTH:]  # Last 6 messages for context
     conversation_context = ""
     if recent_messages:
+        # Label from the end, the newest entry is always the current user message
         conversation_context = "Recent conversation:\n" + "\n".join([
-            f"{'User' if i % 2 == 0 else 'Assistant'}: {msg}" 
+            f"{'User' if (len(recent_messages) - 1 - i) % 2 == 0 else 'Assistant'}: {msg}" 
             for i, msg in enumerate(recent_messages)
         ]) + "\n\n"
+    return conversation_context
+
+def build_reservation_context(state: ChatbotState) -> str:
+    """Format the reservation details collected so far"""
+    return RESERVATION_STATUS_TEMPLATE.format(
+        date=state.get("date") or "Not provided",
+        time=state.get("time") or "Not provided",
+        persons=state.get("persons") or "Not provided"
+    )
+
+def build_turn_prompt(state: ChatbotState) -> str:
+    """Per-turn user prompt: recent conversation, reservation status and the user message"""
+    return TURN_PROMPT_TEMPLATE.format(
+        conversation_context=build_conversation_context(state),
+        reservation_context=build_reservation_context(state),
+        user_msg=state["user_message"]
+    )
+
+def greeting_reply(state: ChatbotState) -> str:
+    """Canned reply to a plain greeting, asking for the next missing reservation detail"""
+    question = next(
+        (question for slot, question in SLOT_QUESTIONS.items() if not state.get(slot)),
+        "How can I help you with your reservation?"
+    )
+    return f"Hello! I'm your restaurant assistant. {question}"
+
+async def prefilter_message(state: ChatbotState) -> ChatbotState:
+    """Resolve the intent locally when possible, so the turn can skip the LLM analysis"""
+    user_msg = state["user_message"]
     
-    reservation_context = f"""
-    Current reservation status:
-    - Date: {current_date if current_date else 'Not provided'}
-    - Time: {current_time if current_time else 'Not provided'}
-    - Number of persons: {current_persons if current_persons else 'Not provided'}
-    """
+    # Questions matching a KB entry skip the LLM entirely
+    kb_answer = lookup_knowledge(user_msg)
+    if kb_answer:
+        state["intent"] = "knowledge"
+        state["reply"] = kb_answer
+        return state
     
-    reservation_prompt = f"""
-    You are a helpful restaurant reservation assistant. Your job is to collect three required pieces of information:
-    1. Date (when they want to dine)
-    2. Time (what time they prefer)  
-    3. Number of persons (how many people)
+    # Profanity and gibberish get canned replies, so no LLM call is needed once they are recognized
+    local_intent = classify_locally(user_msg)
+    if local_intent:
+        state["intent"] = local_intent
+        return state
+    
+    # Plain greetings start (or resume) the reservation flow
+    if GREETING_RE.fullmatch(user_msg):
+        state["intent"] = "reservation"
+        state["reply"] = greeting_reply(state)
+    return state
 
-    {conversation_context}
-    {reservation_context}
+async def analyze_message(state: ChatbotState, config: RunnableConfig) -> ChatbotState:
+    """Classify the message, extract reservation details and draft the reply in one LLM call"""
+    user_msg = state["user_message"]
     
-    -if user has provided all three information, then ask to confirm these details.
-    -if user confirms all the details, then return only YES in response. otherwise continue the conversation.
+    # Streamed turns classify first, so knowledge and contradiction handlers can stream their reply token by token.
+    # Reservation replies are rewritten (YES, confirmation summary) before they are sent, so they use the combined call.
+    if get_token_sink(config):
+        state["intent"] = await intent_batcher.classify(user_msg)
+        if state["intent"] != "reservation":
+            return state
     
-    User message: "{user_msg}"
+    try:
+        analysis = orjson.loads(await get_llm_response(build_turn_prompt(state), model=REPLY_MODEL, json_mode=True, system=ANALYSIS_SYSTEM_PROMPT))
+    except orjson.JSONDecodeError:
+        analysis = {}
+    if not isinstance(analysis, dict):
+        analysis = {}
     
-    Instructions:
+    intent = str(analysis.get("intent") or "").lower().strip()
+    if intent not in VALID_INTENTS:
+        intent = "reservation"  # Default fallback
     
-    Parse “fuzzy” time expressions (e.g., “book a table this weekend or maybe
-    Monday morning”) into a structured “BookReservation” intent with candidate slots
-    (date_candidates = [“this Saturday”, “this Sunday”, “Monday morning”]).
+    state["intent"] = intent
+    if intent == "reservation":
+        # A confirmed reservation ends the turn without a handler (see determine_next_node), so it is left unchanged
+        if state.get("reservation_complete"):
+            return state
+        state["slots"] = {slot: analysis[slot] for slot in ("date", "time", "persons") if analysis.get(slot)}
     
-    -If multiple candidates remain unresolved, the chatbot must proactively ask one
-    clarifying question (“Do you prefer Saturday, Sunday, or Monday morning?”)
-    rather than assuming or failing silently
+    # Handlers generate their own reply when the combined call did not provide one
+    reply = analysis.get("response")
+    state["reply"] = reply.strip() if isinstance(reply, str) and reply.strip() else None
+    return state
+
+async def extract_reservation_details(state: ChatbotState) -> Dict[str, Any]:
+    """Extract date/time/persons from the user message"""
+    user_msg = state["user_message"]
     
-    - Use the conversation history to maintain context
-    - If the user message contains any missing information, extract and acknowledge it
-    - Ask for the next missing piece of information naturally
-    - If you have all three pieces, confirm the reservation
-    - Be conversational and remember what was discussed before
-    - Don't ask for information you already have
+    extraction_prompt = EXTRACTION_PROMPT_TEMPLATE.format(user_msg=user_msg)
 
-    -if user has provided all three details and confirms all the details, then return only YES in response. otherwise continue the conversation.
-    Respond naturally and ask for the next needed information if incomplete.
-    """
+    extraction_result = await get_llm_response(extraction_prompt, model=EXTRACTOR_MODEL, json_mode=True, system=EXTRACTION_SYSTEM_PROMPT)
+    try:
+        extracted_info = orjson.loads(extraction_result)
+    except orjson.JSONDecodeError:
+        extracted_info = None
+    if not isinstance(extracted_info, dict):
+        logger.warning("Could not parse reservation details from extractor output: %r", extraction_result)
+        return {}
     
-    response = get_llm_response(reservation_prompt)
-    # print("AI MESSAGE:",response)
+    return {slot: extracted_info[slot] for slot in ("date", "time", "persons") if extracted_info.get(slot)}
+
+async def handle_reservation(state: ChatbotState) -> ChatbotState:
+    """Handle reservation-related conversation with persistent context"""
+    response = state.get("reply")
+    if response is None:
+        # The reply and the slot extraction don't depend on each other, so run both calls concurrently.
+        # The extracted slots are only applied after the confirmation check below.
+        response, state["slots"] = await asyncio.gather(
+            get_llm_response(build_turn_prompt(state), system=RESERVATION_SYSTEM_PROMPT),
+            extract_reservation_details(state)
+        )
+    # A confirmation only counts for details the user has already seen in the summary, so check before this turn's slots
     if state.get("date") and state.get("time") and state.get("persons") and response.strip() == "YES":
         state["reservation_complete"] = True
-        response = "Thanks for confirmation, The table will be reserved for you. See you soon."
-        state["messages"].append(AIMessage(content=response))
+        state["reply"] = "Thanks for confirmation, The table will be reserved for you. See you soon."
         return state
-    
-    # Extract information from user message
-    extraction_prompt = f"""
-    You are an information extractor.
-
-    Your task is to extract reservation details from this user message: "{user_msg}"
-
-    Follow these rules strictly:
-    1. If the message contains more than one date or time, set both 'date' and 'time' to null.
-    2. Extract 'date' and 'time' only if they are mentioned once and clearly.
-    3. If any of the fields (date, time, persons) are not found, set them to null.
-    4. Return ONLY a raw JSON object, without any explanation, markdown, or labels.
-    5. Do not include keys with invalid values like empty strings; use `null`.
-
-    Expected JSON format:
-    {{
-    "date": "date or day of the week, or null",
-    "time": "time in readable format or null",
-    "persons": "number of persons as string or null"
-    }}
-
-    Examples:
-    Input: Book on this Monday or Tuesday  
-    Output: {{"date": None, "time": None, "persons": None}}
-
-    Input: Book on this Monday  
-    Output: {{"date": "Monday", "time": None, "persons": None}}
-
-    Input: Book for 12pm, 2 people  
-    Output: {{"date": None, "time": "12 pm", "persons": "2"}}
-
-    Now extract from this:
-    "{user_msg}"
-    """
-    
-
-    try:
-        extraction_result = get_llm_response(extraction_prompt)
-        # print("user:",user_msg,"extraction_result:",extraction_result)
-        
-        import re
-        json_match = re.search(r'\{.*\}', extraction_result, re.DOTALL)
-        if json_match:
-            extracted_info = json.loads(json_match.group())
-            
-            if extracted_info.get("date"):
-                state["date"] = extracted_info["date"]
-            if extracted_info.get("time"):
-                state["time"] = extracted_info["time"]
-            if extracted_info.get("persons"):
-                state["persons"] = extracted_info["persons"]
-    except:
-        pass
+    state.update(state.get("slots") or {})
     
     # Check completion
     if state.get("date") and state.get("time") and state.get("persons"):
-        
-        
-        confirmation_prompt = f"""
-        Reservation details:
-        Date: {state['date']},
-        Time: {state['time']},
-        Persons: {state['persons']}
-        
-        Please respond with "yes please confirm" or let me know for any change.
-        """
-
-        response = confirmation_prompt
+        response = CONFIRMATION_TEMPLATE.format(date=state["date"], time=state["time"], persons=state["persons"])
     
-    state["messages"].append(AIMessage(content=response))
+    state["reply"] = response
     return state
 
-def handle_knowledge(state: ChatbotState) -> ChatbotState:
+async def handle_knowledge(state: ChatbotState, config: RunnableConfig) -> ChatbotState:
     """Handle general world knowledge queries (off-topic from reservations)"""
     user_msg = state["user_message"]
     
-    # Convert knowledge base to string for LLM
-    kb_content = "\n".join([f"- {key.replace('_', ' ').title()}: {value}" for key, value in KNOWLEDGE_BASE.items()])
-    
-    knowledge_prompt = f"""
-    You are a helpful AI assistant with access to general world knowledge. Use the following knowledge base to answer the user's question:
-
-    KNOWLEDGE BASE:
-    {kb_content}
-
-    User question: "{user_msg}"
-
-    Instructions:
-    - Use the information from the knowledge base above to answer questions
-    - If the question isn't covered in the knowledge base, politely say I dont have information on that.
-    - After answering the knowledge question, politely remind the user to redirect them back to table reservations without extra question added.
-
-    Provide a helpful short response and then redirect to reservations.
-    """
-    
-    response = get_llm_response(knowledge_prompt)
-    state["messages"].append(AIMessage(content=response))
+    response = state.get("reply") or lookup_knowledge(user_msg) or cached_knowledge_answer(user_msg)
+    if response is None:
+        knowledge_prompt = f'User question: "{user_msg}"'
+        
+        response = await get_llm_response(knowledge_prompt, system=KNOWLEDGE_SYSTEM_PROMPT, on_token=get_token_sink(config))
+        remember_knowledge_answer(user_msg, response)
+    state["reply"] = response
     return state
 
-def handle_gibberish(state: ChatbotState) -> ChatbotState:
+async def handle_gibberish(state: ChatbotState) -> ChatbotState:
     """Handle gibberish/unclear messages"""
-    # user_msg = state["user_message"]
-    
-    # gibberish_prompt = f"""
-    # The user sent a message that appears to be gibberish or unclear: "{user_msg}"
-    
-    # Respond politely asking them to rephrase their message. Be helpful and mention that you can assist with:
-    # - Table reservations
-    # - Restaurant information
-    # - General questions
-    
-    # Keep it friendly and brief.
-    # """
-    
-    # response = get_llm_response(gibberish_prompt)
-    state["messages"].append(AIMessage(content="I’m sorry, I didn’t catch that—could you rephrase?"))
+    state["reply"] = GIBBERISH_RESPONSE
     return state
 
-def handle_contradiction(state: ChatbotState) -> ChatbotState:
+async def handle_contradiction(state: ChatbotState, config: RunnableConfig) -> ChatbotState:
     """Handle contradictory or false statements"""
     user_msg = state["user_message"]
     
-    contradiction_prompt = f"""
-    The user made a statement that contains a contradiction or false information: "{user_msg}"
-    
-    Politely correct the misinformation with the accurate facts in just one sentence. 
-    After the correction, Tell customer to continue reservation conversaton with no extra question added.
-    
-    Keep the response very precise and short; and redirect to restaurant services.
-    """
-    
-    response = get_llm_response(contradiction_prompt)
-    state["messages"].append(AIMessage(content=response))
+    response = state.get("reply")
+    if response is None:
+        contradiction_prompt = f'User statement: "{user_msg}"'
+        
+        response = await get_llm_response(contradiction_prompt, system=CONTRADICTION_SYSTEM_PROMPT, on_token=get_token_sink(config))
+    state["reply"] = response
     return state
 
-def handle_profanity(state: ChatbotState) -> ChatbotState:
+async def handle_profanity(state: ChatbotState) -> ChatbotState:
     """Handle profanity or disrespectful messages"""
-    profanity_responses = [
-        "Let's keep our conversation respectful, please. I'm here to help with your restaurant needs.",
-        "I'd appreciate if we could maintain a polite conversation. How can I assist you with our restaurant services?",
-        "Let's focus on how I can help you today. I can assist with reservations or answer questions about our restaurant.",
-        "I'm here to provide helpful service. Please let me know how I can assist you with restaurant-related questions."
-    ]
-    
-    import random
-    response = random.choice(profanity_responses)
-    state["messages"].append(AIMessage(content=response))
+    state["reply"] = random.choice(PROFANITY_RESPONSES)
     return state
 
 
@@ -365,11 +769,16 @@ def determine_next_node(state: ChatbotState) -> str:
     
     return route_map.get(intent, "reservation")  # Default to knowledge
 
+def route_after_prefilter(state: ChatbotState) -> str:
+    """Skip the LLM analysis when the prefilter already resolved the intent"""
+    return determine_next_node(state) if state.get("intent") else "analyze_message"
+
 def create_multi_tool_workflow():
     """Create the multi-tool workflow"""
     workflow = StateGraph(ChatbotState)
     
     # Add all nodes
+    workflow.add_node("prefilter", prefilter_message)
     workflow.add_node("analyze_message", analyze_message)
     workflow.add_node("reservation", handle_reservation)
     workflow.add_node("knowledge", handle_knowledge)
@@ -378,9 +787,22 @@ def create_multi_tool_workflow():
     workflow.add_node("profanity", handle_profanity)
     
     # Set entry point
-    workflow.set_entry_point("analyze_message")
+    workflow.set_entry_point("prefilter")
     
     # Add conditional routing
+    workflow.add_conditional_edges(
+        "prefilter",
+        route_after_prefilter,
+        {
+            "analyze_message": "analyze_message",
+            "reservation": "reservation",
+            "knowledge": "knowledge",
+            "gibberish": "gibberish", 
+            "contradiction": "contradiction",
+            "profanity": "profanity",
+            END: END
+        }
+    )
     workflow.add_conditional_edges(
         "analyze_message",
         determine_next_node,
@@ -403,75 +825,206 @@ def create_multi_tool_workflow():
 # Initialize workflow
 chatbot_workflow = create_multi_tool_workflow()
 
-def get_or_create_session(session_id: str) -> ChatbotState:
+def new_session() -> ChatbotState:
+    """Initial state for a new session"""
+    return {
+        "user_message": "",
+        "intent": "",
+        "date": None,
+        "time": None,
+        "persons": None,
+        "reservation_complete": False,
+        "conversation_history": deque(maxlen=HISTORY_LENGTH),
+        "slots": {},
+        "reply": None
+    }
+
+def serialize_session(state: ChatbotState) -> bytes:
+    """Encode a session for Redis"""
+    return orjson.dumps({**state, "conversation_history": list(state["conversation_history"])})
+
+def deserialize_session(data: bytes) -> ChatbotState:
+    """Decode a session stored by serialize_session"""
+    state = orjson.loads(data)
+    state.pop("messages", None)  # Sessions saved before the LangChain message list was dropped
+    state["conversation_history"] = deque(state["conversation_history"], maxlen=HISTORY_LENGTH)
+    return state
+
+async def load_session(session_id: str) -> Optional[ChatbotState]:
+    """Get an existing session, or None"""
+    if redis_client is None:
+        return sessions.get(session_id)
+    data = await redis_client.get(f"sess:{session_id}")
+    return deserialize_session(data) if data else None
+
+async def save_session(session_id: str, state: ChatbotState) -> None:
+    """Store a session and refresh its expiry"""
+    if redis_client is None:
+        sessions[session_id] = state
+    else:
+        await redis_client.setex(f"sess:{session_id}", SESSION_TTL_SECONDS, serialize_session(state))
+
+async def delete_session(session_id: str) -> bool:
+    """Remove a session, returning whether it existed"""
+    if redis_client is None:
+        return sessions.pop(session_id, None) is not None
+    return await redis_client.delete(f"sess:{session_id}") > 0
+
+async def get_or_create_session(session_id: str) -> ChatbotState:
     """Get existing session or create new one"""
-    if session_id not in sessions:
-        sessions[session_id] = {
-            "messages": [AIMessage(content="Hello! I'm your restaurant assistant. I can help you with table reservations, answer questions about our restaurant, or assist with other inquiries. How can I help you today?")],
-            "user_message": "",
-            "intent": "",
-            "date": None,
-            "time": None,
-            "persons": None,
-            "reservation_complete": False,
-            "conversation_history": []
-        }
-    return sessions[session_id]
+    state = await load_session(session_id)
+    if state is None:
+        state = new_session()
+    return state
+
+# The knowledge base is static, so its response body is encoded once
+KNOWLEDGE_RESPONSE_BYTES = orjson.dumps({
+    "total_entries": len(KNOWLEDGE_BASE),
+    "knowledge_base": KNOWLEDGE_BASE,
+    "note": "This contains general world knowledge questions and is considered off-topic from restaurant reservations"
+})
+KNOWLEDGE_ETAG = f'"{hashlib.blake2b(KNOWLEDGE_RESPONSE_BYTES, digest_size=16).hexdigest()}"'
+KNOWLEDGE_HEADERS = {"Cache-Control": "public, max-age=3600", "ETag": KNOWLEDGE_ETAG}
 
 @app.get("/knowledge")
-async def get_knowledge_base():
+async def get_knowledge_base(request: Request):
     """Get all knowledge base entries"""
-    return {
-        "total_entries": len(KNOWLEDGE_BASE),
-        "knowledge_base": KNOWLEDGE_BASE,
-        "note": "This contains general world knowledge questions and is considered off-topic from restaurant reservations"
+    if request.headers.get("if-none-match") == KNOWLEDGE_ETAG:
+        return Response(status_code=304, headers=KNOWLEDGE_HEADERS)
+    return Response(content=KNOWLEDGE_RESPONSE_BYTES, media_type="application/json", headers=KNOWLEDGE_HEADERS)
+
+async def start_turn(message: ChatMessage) -> ChatbotState:
+    """Load the session and add the user message for a new turn"""
+    # Get or create session
+    state = await get_or_create_session(message.session_id)
+    
+    # Add to conversation history
+    state["conversation_history"].append(message.message)
+    
+    # Add user message to state
+    state["user_message"] = message.message
+    state["intent"] = ""
+    state["slots"] = {}
+    state["reply"] = None
+    return state
+
+async def finish_turn(session_id: str, result: ChatbotState) -> ChatResponse:
+    """Record the assistant reply, save the session and build the API response"""
+    # Add assistant response to history; turns that end without a reply repeat the previous one
+    history = result["conversation_history"]
+    latest_response = result.get("reply") or (history[-2] if len(history) > 1 else None)
+    if latest_response:
+        history.append(latest_response)
+    else:
+        latest_response = "I'm here to help!"
+    
+    # Update session
+    await save_session(session_id, result)
+    
+    # Prepare response
+    reservation_status = {
+        "date": result.get("date"),
+        "time": result.get("time"),
+        "persons": result.get("persons"),
+        "complete": result.get("reservation_complete", False)
     }
+    
+    return ChatResponse(
+        response=latest_response,
+        intent=result.get("intent", "unknown"),
+        reservation_status=reservation_status
+    )
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat(message: ChatMessage):
+# Streamed turns whose client disconnected, finished in the background so their sessions stay consistent
+abandoned_turns: set = set()
+
+async def finish_abandoned_turn(session_id: str, workflow_task: asyncio.Task) -> None:
+    """Wait for the workflow of a disconnected stream and save its turn"""
+    try:
+        await finish_turn(session_id, await workflow_task)
+    except Exception:
+        logger.exception("Could not finish streamed turn for session %s", session_id)
+
+def sse_event(event: str, data: Any) -> bytes:
+    """Encode one Server-Sent Event"""
+    return b"event: " + event.encode() + b"\ndata: " + msgspec.json.encode(data) + b"\n\n"
+
+@app.post(
+    "/chat",
+    openapi_extra={
+        "requestBody": CHAT_REQUEST_BODY,
+        "responses": {"200": {"content": {"application/json": {"schema": CHAT_RESPONSE_SCHEMA}}}}
+    }
+)
+async def chat(message: ChatMessage = Depends(decode_chat_message)):
     """Main chat endpoint with multi-tool routing"""
     try:
-        # Get or create session
-        state = get_or_create_session(message.session_id)
-        
-        # Add to conversation history
-        state["conversation_history"].append(message.message)
-        
-        # Add user message to state
-        state["user_message"] = message.message
-        state["messages"].append(HumanMessage(content=message.message))
+        state = await start_turn(message)
         
         # Process through workflow
-        result = chatbot_workflow.invoke(state)
+        result = await chatbot_workflow.ainvoke(state)
         
-        # Update session
-        sessions[message.session_id] = result
-        
-        # Add assistant response to history
-        ai_messages = [msg for msg in result["messages"] if isinstance(msg, AIMessage)]
-        if ai_messages:
-            latest_response = ai_messages[-1].content
-            result["conversation_history"].append(latest_response)
-        else:
-            latest_response = "I'm here to help!"
-        
-        # Prepare response
-        reservation_status = {
-            "date": result.get("date"),
-            "time": result.get("time"),
-            "persons": result.get("persons"),
-            "complete": result.get("reservation_complete", False)
-        }
-        
-        return ChatResponse(
-            response=latest_response,
-            intent=result.get("intent", "unknown"),
-            reservation_status=reservation_status
-        )
+        response = await finish_turn(message.session_id, result)
+        return Response(content=msgspec.json.encode(response), media_type="application/json")
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
+@app.post(
+    "/chat/stream",
+    response_class=StreamingResponse,
+    openapi_extra={
+        "requestBody": CHAT_REQUEST_BODY,
+        "responses": {"200": {"content": {"text/event-stream": {"schema": {"type": "string"}}}}}
+    }
+)
+async def chat_stream(message: ChatMessage = Depends(decode_chat_message)):
+    """Chat endpoint streaming the reply as Server-Sent Events.
+
+    Emits "token" events with reply deltas, then a "done" event with the same body as POST /chat.
+    Knowledge and contradiction replies are streamed as they are generated; other replies arrive as one token event.
+    If the client disconnects, the turn still completes and is saved.
+    """
+    try:
+        state = await start_turn(message)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+    
+    tokens: asyncio.Queue = asyncio.Queue()
+    
+    async def run_workflow() -> ChatbotState:
+        try:
+            return await chatbot_workflow.ainvoke(state, config={"configurable": {"on_token": tokens.put}})
+        finally:
+            await tokens.put(None)
+    
+    async def event_stream():
+        workflow_task = asyncio.create_task(run_workflow())
+        finishing = False
+        try:
+            streamed = False
+            while (delta := await tokens.get()) is not None:
+                streamed = True
+                yield sse_event("token", {"delta": delta})
+            
+            finishing = True
+            try:
+                response = await finish_turn(message.session_id, await workflow_task)
+            except Exception as e:
+                yield sse_event("error", {"detail": f"Error: {str(e)}"})
+                return
+            
+            if not streamed:
+                yield sse_event("token", {"delta": response.response})
+            yield sse_event("done", response)
+        finally:
+            if not finishing:
+                task = asyncio.create_task(finish_abandoned_turn(message.session_id, workflow_task))
+                abandoned_turns.add(task)
+                task.add_done_callback(abandoned_turns.discard)
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 @app.get("/")
 async def root():
     """API information"""
@@ -486,24 +1039,20 @@ async def root():
         ],
         "endpoints": {
             "POST /chat": "Send message to chatbot",
+            "POST /chat/stream": "Send message to chatbot, streaming the reply as Server-Sent Events",
             "GET /session/{session_id}": "Get session status",
             "DELETE /session/{session_id}": "Clear session",
             "GET /knowledge": "View knowledge base"
         }
     }
 
-@app.get("/knowledge")
-async def get_knowledge_base():
-    """View the general world knowledge base"""
-    return {"knowledge_base": KNOWLEDGE_BASE, "note": "This contains general world knowledge questions and is considered off-topic from restaurant reservations"}
-
 @app.get("/session/{session_id}")
 async def get_session(session_id: str):
     """Get session status"""
-    if session_id not in sessions:
+    state = await load_session(session_id)
+    if state is None:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    state = sessions[session_id]
     return {
         "session_id": session_id,
         "current_intent": state.get("intent", "none"),
@@ -513,19 +1062,21 @@ async def get_session(session_id: str):
             "persons": state.get("persons"),
             "complete": state.get("reservation_complete", False)
         },
-        "message_count": len(state["messages"]),
+        # The history holds every message but the opening greeting, which the message count always included
+        "message_count": min(len(state.get("conversation_history", [])) + 1, HISTORY_LENGTH),
         "conversation_length": len(state.get("conversation_history", []))
     }
 
 @app.delete("/session/{session_id}")
 async def clear_session(session_id: str):
     """Clear session data"""
-    if session_id in sessions:
-        del sessions[session_id]
+    if await delete_session(session_id):
         return {"message": f"Session {session_id} cleared"}
     else:
         raise HTTPException(status_code=404, detail="Session not found")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Workers only share sessions through Redis, so without it a single worker is used
+    workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() if redis_client else 1))
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=workers, loop="uvloop", http="httptools")
\ No newline at end of file